@@ -17,6 +17,41 @@ NimBLECharacteristic* pAckCharacteristic;
 SemaphoreHandle_t ackSemaphore = NULL;
 SemaphoreHandle_t startTransferSemaphore = NULL;  // 新しく追加するセマフォ
 
+// Fills buffer with the next chunk of the transfer stream, LZSS-compressing the file when requested.
+size_t readTransferChunk(File& file, uint8_t* buffer, size_t chunkSize) {
+  if (!g_transfer_compressed) {
+    return file.read(buffer, chunkSize);
+  }
+
+  uint8_t input[256];
+  size_t written = 0;
+  while (written < chunkSize) {
+    size_t polled = lzss_poll(g_lzss_encoder, buffer + written, chunkSize - written);
+    written += polled;
+    if (written == chunkSize) {
+      break;
+    }
+    if (polled > 0) {
+      continue;
+    }
+    if (g_lzss_encoder.finishing) {
+      break;  // Stream fully drained
+    }
+
+    // Encoder needs more input: top it up from the file
+    size_t bytesRead = file.read(input, sizeof(input));
+    if (bytesRead == 0) {
+      lzss_finish(g_lzss_encoder);
+      continue;
+    }
+    size_t sunk = lzss_sink(g_lzss_encoder, input, bytesRead);
+    if (sunk < bytesRead) {
+      file.seek(file.position() - (bytesRead - sunk));  // Re-read the remainder next time
+    }
+  }
+  return written;
+}
+
 void transferFileChunked() {
   if (!g_start_file_transfer) {
     return;
@@ -30,7 +65,8 @@ void transferFileChunked() {
   }
 
   // --- START 信号送信とACK待機 ---
-  pResponseCharacteristic->setValue("START");
+  // "START:LZSS" tells the client that the chunk payloads are compressed
+  pResponseCharacteristic->setValue(g_transfer_compressed ? "START:LZSS" : "START");
   pResponseCharacteristic->notify();
   applog("Sent START signal. Waiting for ACK...");
 
@@ -69,7 +105,11 @@ void transferFileChunked() {
   if (LittleFS.exists(g_file_to_transfer_name.c_str())) {
     File file = LittleFS.open(g_file_to_transfer_name.c_str(), "r");
     if (file) {
-      applog("Starting to send file: %s, size: %u", g_file_to_transfer_name.c_str(), file.size());
+      applog("Starting to send file: %s, size: %u%s", g_file_to_transfer_name.c_str(), file.size(),
+             g_transfer_compressed ? " (LZSS)" : "");
+      if (g_transfer_compressed) {
+        lzss_init(g_lzss_encoder);
+      }
       const size_t chunkSize = 508; // Adjusted for 4-byte chunk index to fit in 512-byte packet
       uint8_t buffer[chunkSize];
       uint8_t packet[chunkSize + 4]; // Total packet size will be 512 bytes
@@ -88,7 +128,7 @@ void transferFileChunked() {
         int chunk_burst_size_local = g_chunk_burst_size;
 
         for (int i = 0; i < chunk_burst_size_local; ++i) {
-          bytesRead = file.read(buffer, chunkSize);
+          bytesRead = readTransferChunk(file, buffer, chunkSize);
           if (bytesRead <= 0) {
             eofReachedInBurst = true;
             break;  // End of file
@@ -179,9 +219,74 @@ void transferFileChunked() {
   g_start_file_transfer = false;
 }
 
+// --- Control Responses ---
+// Control responses are framed as a "LEN:<bytes>" header followed by continuation
+// packets sized to the negotiated MTU, so replies longer than one notification arrive intact.
+// BLE callbacks only queue the reply; sendPendingResponse() sends it from the main loop,
+// because the NimBLE host task cannot free notification buffers while a callback holds it.
+static void queue_response(const std::string& response, bool restartAfterSend = false) {
+  g_pending_response = response;
+  g_restart_after_response = restartAfterSend;
+  g_response_pending = true;
+}
+
+// Notifies one response packet, retrying while the BLE stack is out of buffers.
+static bool notify_response_packet(const uint8_t* data, size_t len) {
+  pResponseCharacteristic->setValue(data, len);
+  unsigned long startTime = millis();
+  while (!pResponseCharacteristic->notify()) {
+    if (!isBLEConnected() || millis() - startTime > 2000) {
+      applog("ERROR: Failed to notify response packet");
+      return false;
+    }
+    delay(10);  // Wait a bit for the buffer to clear
+  }
+  return true;
+}
+
+void sendPendingResponse() {
+  if (!g_response_pending) {
+    return;
+  }
+
+  std::string response = g_pending_response;
+  bool restartAfterSend = g_restart_after_response;
+  g_response_pending = false;
+
+  char header[16];
+  snprintf(header, sizeof(header), "LEN:%u", (unsigned)response.length());
+  bool sent = notify_response_packet((const uint8_t*)header, strlen(header));
+
+  size_t payloadSize = g_ble_mtu - 3;  // ATT notification header
+  if (payloadSize > 512) {
+    payloadSize = 512;  // Max attribute value length
+  }
+  for (size_t offset = 0; sent && offset < response.length(); offset += payloadSize) {
+    size_t len = response.length() - offset;
+    if (len > payloadSize) {
+      len = payloadSize;
+    }
+    sent = notify_response_packet((const uint8_t*)response.data() + offset, len);
+  }
+  g_lastActivityTime = millis();
+
+  if (restartAfterSend) {
+    delay(100);  // Let the last notification go out before restarting
+    ESP.restart();
+  }
+}
+
 // --- Command Handlers ---
 static void handle_get_file(const std::string& value) {
   std::string file_info = value.substr(std::string("GET:file:").length());
+
+  // Optional trailing ":lz" requests LZSS compression
+  bool compress_requested = false;
+  if (file_info.ends_with(":lz")) {
+    compress_requested = true;
+    file_info = file_info.substr(0, file_info.length() - 3);
+  }
+
   size_t last_colon_pos = file_info.rfind(':');
 
   if (last_colon_pos != std::string::npos) {
@@ -200,6 +305,8 @@ static void handle_get_file(const std::string& value) {
     g_file_to_transfer_name += file_info;
     g_chunk_burst_size = 8; // Default value
   }
+  // WAV files are PCM/ADPCM audio and barely compress, so always send them raw
+  g_transfer_compressed = compress_requested && !g_file_to_transfer_name.ends_with(".wav");
   g_start_file_transfer = true;
 }
 
@@ -359,6 +466,7 @@ static std::string handle_get_info() {
   doc["littlefs_used_bytes"] = usedBytes;
   doc["littlefs_usage_percent"] = (totalBytes > 0) ? (int)((float)usedBytes / totalBytes * 100) : 0;
   doc["buf_ovf"] = g_buffer_overflow_count;
+  doc["lzss"] = true;  // GET:file accepts the ":lz" compression flag
   std::string jsonResponseStd;
   serializeJson(doc, jsonResponseStd);
   return jsonResponseStd;
@@ -372,14 +480,10 @@ static void handle_set_setting_ini(const std::string& value) {
     file.print(settingContent.c_str());
     file.close();
     responseData = "OK: setting.ini saved. Restarting...";
-    pResponseCharacteristic->setValue(responseData.c_str());
-    pResponseCharacteristic->notify();
-    delay(100);
-    ESP.restart();
+    queue_response(responseData, true);  // Restarts once the reply is sent
   } else {
     responseData = "ERROR: Failed to open setting.ini for writing";
-    pResponseCharacteristic->setValue(responseData.c_str());
-    pResponseCharacteristic->notify();
+    queue_response(responseData);
     applog(responseData.c_str());
   }
 }
@@ -434,15 +538,13 @@ static std::string handle_set_time(const std::string& value) {
 
 static void handle_cmd_reset_all() {
   if (!LittleFS.begin(true)) {
-    pResponseCharacteristic->setValue("LittleFS Mount Failed");
-    pResponseCharacteristic->notify();
+    queue_response("LittleFS Mount Failed");
     return;
   }
 
   File root = LittleFS.open("/");
   if (!root) {
-    pResponseCharacteristic->setValue("Failed to open root directory");
-    pResponseCharacteristic->notify();
+    queue_response("Failed to open root directory");
     return;
   }
 
@@ -474,10 +576,7 @@ static void handle_cmd_reset_all() {
 
   char response[50];
   sprintf(response, "Deleted %d files.", deleted_count);
-  pResponseCharacteristic->setValue(response);
-  pResponseCharacteristic->notify();
-  delay(100);
-  ESP.restart();
+  queue_response(response, true);  // Restarts once the reply is sent
 }
 
 // --- BLE Callbacks ---
@@ -504,8 +603,13 @@ class MyCallbacks : public NimBLECharacteristicCallbacks {
 
       if (g_currentAppState != IDLE) {
         std::string busyMessage = "ERROR: Device is busy (State: " + std::string(appStateStrings[g_currentAppState]) + "). Command rejected.";
-        pResponseCharacteristic->setValue(busyMessage.c_str());
-        pResponseCharacteristic->notify();
+        if (value.rfind("GET:file:", 0) == 0) {
+          // File transfer clients expect a bare "ERROR:" notification instead of a framed response
+          pResponseCharacteristic->setValue(busyMessage.c_str());
+          pResponseCharacteristic->notify();
+        } else {
+          queue_response(busyMessage);
+        }
         applog(busyMessage.c_str());
         return;
       }
@@ -536,9 +640,8 @@ class MyCallbacks : public NimBLECharacteristicCallbacks {
         return;  // Function handles response and restart
       }
 
-      pResponseCharacteristic->setValue(responseData.c_str());
-      pResponseCharacteristic->notify();
-      applog("Sent notification: %s", responseData.c_str());
+      queue_response(responseData);
+      applog("Queued response: %s", responseData.c_str());
     }
   }
 };
@@ -581,8 +684,14 @@ void start_ble_server() {
   class MyServerCallbacks : public NimBLEServerCallbacks {
     void onConnect(NimBLEServer* pServer, NimBLEConnInfo& connInfo) override {
       applog("Client Connected");
+      g_ble_mtu = connInfo.getMTU();
     };
 
+    void onMTUChange(uint16_t MTU, NimBLEConnInfo& connInfo) override {
+      applog("MTU updated to %u", MTU);
+      g_ble_mtu = MTU;
+    }
+
     void onDisconnect(NimBLEServer* pServer, NimBLEConnInfo& connInfo, int reason) override {
       applog("Client Disconnected");
       // Only restart advertising if in a valid state
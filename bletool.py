@@ -1,5 +1,6 @@
 import re
 import json
+import codecs
 import asyncio
 import time
 import argparse
@@ -21,6 +22,8 @@ ACK_UUID = "beb5483e-36e1-4688-b7f5-ea07361b26ac"
 
 # Global variables and events for response data
 received_response_data = bytearray()
+g_framed_response = None # FramedResponse for the control command in flight
+g_framing_seen = False # The connected firmware frames its replies with LEN: headers
 response_event = asyncio.Event()
 start_transfer_event = asyncio.Event() # For handshake
 is_receiving_file = False
@@ -34,13 +37,97 @@ file_transfer_start_time = 0.0
 g_ack_chunk_size = 1 # Default to 1 (ACK every chunk)
 received_chunk_count_for_ack = 0
 
+# For compressed file transfers (see lzss.h)
+g_use_compression = True # Request LZSS for non-WAV files when the device supports it
+g_lzss_decoder = None # Set when the device answers START:LZSS
+received_compressed_bytes = 0
+
+# For chunk order checking
+g_expected_chunk_index = 0
+g_transfer_failed = False
+
+class LzssDecoder:
+    """Incremental decoder for the LZSS stream produced by lzss.h."""
+    WINDOW_SIZE = 2048
+    MIN_MATCH = 3
+
+    def __init__(self):
+        self.window = bytearray()
+        self.flags = 0
+        self.items_left = 0 # Items remaining in the current flag group
+        self.pending = None # First byte of a back reference split across chunks
+
+    def feed(self, data: bytes) -> bytes:
+        out = bytearray()
+        for byte in data:
+            if self.items_left == 0:
+                self.flags = byte
+                self.items_left = 8
+            elif self.flags & 1:
+                out.append(byte)
+                self.window.append(byte)
+                self._next_item()
+            elif self.pending is None:
+                self.pending = byte
+            else:
+                code = (self.pending << 8) | byte
+                self.pending = None
+                distance = (code >> 5) + 1
+                length = (code & 0x1F) + self.MIN_MATCH
+                if distance > len(self.window):
+                    raise ValueError(f"back reference distance {distance} exceeds decoded history {len(self.window)}")
+                for _ in range(length):
+                    value = self.window[-distance]
+                    out.append(value)
+                    self.window.append(value)
+                self._next_item()
+            if len(self.window) > self.WINDOW_SIZE * 2:
+                del self.window[:-self.WINDOW_SIZE]
+        return bytes(out)
+
+    def _next_item(self):
+        self.flags >>= 1
+        self.items_left -= 1
+
+class FramedResponse:
+    """Reassembles a control response sent as a LEN:<bytes> header plus continuation packets."""
+
+    def __init__(self, header: bytes):
+        self.expected_len = int(header[len(b'LEN:'):])
+        self.buffer = bytearray(self.expected_len) # Preallocated from the header
+        self.received_len = 0
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._text_parts = []
+        if self.expected_len == 0:
+            self._text_parts.append(self._decoder.decode(b'', final=True))
+
+    @property
+    def complete(self) -> bool:
+        return self.received_len >= self.expected_len
+
+    def feed(self, data: bytes):
+        chunk = data[:self.expected_len - self.received_len]
+        self.buffer[self.received_len:self.received_len + len(chunk)] = chunk
+        self.received_len += len(chunk)
+        # Decode as packets arrive; multi-byte characters may straddle packets
+        self._text_parts.append(self._decoder.decode(chunk, final=self.complete))
+
+    @property
+    def text(self) -> str:
+        return ''.join(self._text_parts)
+
 # Notification handler function
 async def notification_handler(characteristic: BleakGATTCharacteristic, data: bytearray):
     global received_response_data, is_receiving_file, g_client, total_received_bytes
     global g_total_file_size_for_transfer, file_transfer_start_time, received_chunk_count_for_ack, g_ack_chunk_size
+    global g_lzss_decoder, received_compressed_bytes, g_framed_response
+    global g_expected_chunk_index, g_transfer_failed, g_framing_seen
     if is_receiving_file:
-        if data == b'START':
+        if data == b'START' or data == b'START:LZSS':
             print("Received START signal.")
+            if data == b'START:LZSS':
+                print("LZSS圧縮転送が有効です。")
+                g_lzss_decoder = LzssDecoder()
             start_transfer_event.set()
             received_chunk_count_for_ack = 0 # Reset chunk counter for new transfer
         elif data == b'EOF' or data.startswith(b'ERROR:'):  # End of file transfer or error
@@ -53,8 +140,29 @@ async def notification_handler(characteristic: BleakGATTCharacteristic, data: by
             file_transfer_start_time = 0.0 # Reset start time
             received_chunk_count_for_ack = 0 # Reset after transfer
         else:
-            total_received_bytes += len(data) # Update total received bytes
-            received_response_data.extend(data)
+            if response_event.is_set():
+                return # Transfer already finished or aborted
+            # A lost or repeated chunk would corrupt the file (and every later LZSS back reference)
+            chunk_index = int.from_bytes(data[:4], 'little')
+            if chunk_index != g_expected_chunk_index:
+                print(f"\n{RED}チャンク番号が不正です (期待値: {g_expected_chunk_index}, 受信: {chunk_index})。転送を中止します。{RESET}")
+                g_transfer_failed = True
+                response_event.set()
+                return
+            g_expected_chunk_index += 1
+            payload = data[4:] # Strip the 4-byte chunk index
+            if g_lzss_decoder:
+                # Expand the compressed payload as it arrives
+                received_compressed_bytes += len(payload)
+                try:
+                    payload = g_lzss_decoder.feed(payload)
+                except ValueError as e:
+                    print(f"\n{RED}LZSSデータの展開に失敗しました: {e}。転送を中止します。{RESET}")
+                    g_transfer_failed = True
+                    response_event.set()
+                    return
+            total_received_bytes += len(payload) # Update total received bytes
+            received_response_data.extend(payload)
             received_chunk_count_for_ack += 1
             
             elapsed_time = time.time() - file_transfer_start_time
@@ -73,8 +181,27 @@ async def notification_handler(characteristic: BleakGATTCharacteristic, data: by
                 await g_client.write_gatt_char(ACK_UUID, b'ACK', response=True)
                 received_chunk_count_for_ack = 0 # Reset after sending ACK to count for the next batch
     else:
-        received_response_data = data
-        response_event.set()
+        if response_event.is_set():
+            return # Late packet after the reply was completed
+        if g_framed_response is None:
+            if not data.startswith(b'LEN:'):
+                if g_framing_seen:
+                    return # Stray continuation of an earlier (timed out) reply
+                # Unframed reply (older firmware): treat a single notification as the whole reply
+                received_response_data = data
+                response_event.set()
+                return
+            try:
+                g_framed_response = FramedResponse(bytes(data))
+            except ValueError:
+                print(f"\n{RED}不正な応答ヘッダを受信: {data!r}{RESET}")
+                return
+            g_framing_seen = True
+        else:
+            g_framed_response.feed(data)
+        if g_framed_response.complete:
+            received_response_data = g_framed_response.buffer
+            response_event.set()
 
 def compare_and_print_diff(device_content: str, local_content: str):
     device_lines = device_content.splitlines()
@@ -107,9 +234,10 @@ def getch():
     return ch
 
 async def run_ble_command(command_str: str, verbose: bool = False, timeout: float = 15.0):
-    global received_response_data, is_receiving_file, g_client
+    global received_response_data, is_receiving_file, g_client, g_framed_response
     is_receiving_file = False
-    received_response_data.clear()
+    received_response_data = bytearray()
+    g_framed_response = None
     response_event.clear()
 
     if verbose:
@@ -125,18 +253,28 @@ async def run_ble_command(command_str: str, verbose: bool = False, timeout: floa
         print(f"{GREEN}   -> コマンド送信完了。応答を待機中...{RESET}")
     try:
         await asyncio.wait_for(response_event.wait(), timeout=timeout)
+        if g_framed_response is not None:
+            return g_framed_response.text
         return received_response_data.decode('utf-8')
     except asyncio.TimeoutError:
-        print(f"{RED}タイムアウト: 応答データが受信されませんでした。{RESET}")
+        if g_framed_response is not None:
+            print(f"{RED}タイムアウト: 応答データが途中で途切れました ({g_framed_response.received_len}/{g_framed_response.expected_len} bytes)。{RESET}")
+        else:
+            print(f"{RED}タイムアウト: 応答データが受信されませんでした。{RESET}")
         return None
 
 async def run_ble_command_for_file(command_str: str, verbose: bool = False, timeout: float = 120.0): # Increased timeout
     global received_response_data, is_receiving_file, total_received_bytes, g_client, file_transfer_start_time
+    global g_lzss_decoder, received_compressed_bytes, g_expected_chunk_index, g_transfer_failed
     is_receiving_file = True
     received_response_data.clear()
     response_event.clear()
     start_transfer_event.clear()
     total_received_bytes = 0 
+    g_lzss_decoder = None
+    received_compressed_bytes = 0
+    g_expected_chunk_index = 0
+    g_transfer_failed = False
     
     if verbose:
         print(f"\n--- BLEファイル転送コマンド実行: コマンド='{command_str}' ---")
@@ -163,6 +301,8 @@ async def run_ble_command_for_file(command_str: str, verbose: bool = False, time
             print(f"{GREEN}   -> ハンドシェイク完了。ファイルデータ受信中...{RESET}")
 
         await asyncio.wait_for(response_event.wait(), timeout=timeout)
+        if g_transfer_failed:
+            return None
         return received_response_data
     
     except asyncio.TimeoutError:
@@ -173,9 +313,11 @@ async def run_ble_command_for_file(command_str: str, verbose: bool = False, time
         return None
     finally:
         is_receiving_file = False
+        g_lzss_decoder = None
 
 async def reconnect_ble_client(verbose: bool = False) -> bool:
-    global g_client, DEVICE_ADDRESS
+    global g_client, DEVICE_ADDRESS, g_framing_seen
+    g_framing_seen = False # The device may have been reflashed
     print(f"{RED}BLEクライアントが切断されました。再接続を試みます...{RESET}")
 
     address = DEVICE_ADDRESS
@@ -353,7 +495,7 @@ async def list_files(extension: str, verbose: bool = False):
         print(f"{RED}エラー: 受信した情報がJSON形式ではありません。{RESET}")
     
 
-async def get_file_from_device(file_extension_filter: str, verbose: bool = False, ack_chunk_size: int = 1):
+async def get_file_from_device(file_extension_filter: str, verbose: bool = False, ack_chunk_size: int = 1, compress: bool = True):
     global received_chunk_count_for_ack, g_total_file_size_for_transfer, g_ack_chunk_size
     g_ack_chunk_size = ack_chunk_size # Set the global ACK chunk size
     received_chunk_count_for_ack = 0 
@@ -414,10 +556,17 @@ async def get_file_from_device(file_extension_filter: str, verbose: bool = False
 
     print(f"デバイスから {selected_filename} を要求中... (予想サイズ: {selected_file_size} bytes)")
     command = f"GET:file:{selected_filename}:{g_ack_chunk_size}"
+    if compress and not selected_filename.lower().endswith(".wav"):
+        # Only firmware that advertises LZSS in GET:info understands the ":lz" flag
+        device_info = await get_device_info(verbose, silent=True)
+        if device_info and device_info.get("lzss"):
+            command += ":lz" # WAV files are sent raw; the device skips them as well
     file_content = await run_ble_command_for_file(command, verbose)
 
     if file_content is not None:
         print(f"Total received file size: {len(file_content)} bytes")
+        if received_compressed_bytes > 0:
+            print(f"Compressed transfer size: {received_compressed_bytes} bytes")
         try:
             with open(selected_filename, 'wb') as f:
                 f.write(file_content)
@@ -536,6 +685,7 @@ async def main():
     parser = argparse.ArgumentParser(description='BLE Tool for fastrec device. Run without arguments for interactive menu.')
     parser.add_argument('-v', '--verbose', action='store_true', help='Enable verbose output.')
     parser.add_argument('-a', '--ack-size', type=int, default=1, help='Set the ACK chunk size for file transfers (default: 1).')
+    parser.add_argument('--no-compress', action='store_true', help='Disable LZSS compression for text file transfers.')
     
     subparsers = parser.add_subparsers(dest='command', help='Sub-command help')
 
@@ -557,8 +707,9 @@ async def main():
     args = parser.parse_args()
     verbose = args.verbose
     
-    global g_ack_chunk_size
+    global g_ack_chunk_size, g_use_compression
     g_ack_chunk_size = args.ack_size
+    g_use_compression = not args.no_compress
     
     global g_client
     try:
@@ -584,7 +735,7 @@ async def main():
             elif args.command == 'ls':
                 await list_files(args.extension, verbose)
             elif args.command == 'get':
-                await get_file_from_device(args.extension, verbose, ack_chunk_size=g_ack_chunk_size)
+                await get_file_from_device(args.extension, verbose, ack_chunk_size=g_ack_chunk_size, compress=g_use_compression)
             elif args.command == 'get_ini':
                 await get_setting_ini(verbose)
             elif args.command == 'set_ini':
@@ -605,7 +756,7 @@ async def main():
 
 
 async def main_loop(verbose: bool = False):
-    global g_client, g_ack_chunk_size
+    global g_client, g_ack_chunk_size, g_use_compression
     try:
         print(f"BLEデバイス '{DEVICE_NAME}' をスキャン中...")
         device = await BleakScanner.find_device_by_name(DEVICE_NAME, timeout=10.0)
@@ -647,7 +798,7 @@ async def main_loop(verbose: bool = False):
             elif choice == '3':
                 await get_device_info(verbose)
             elif choice == '4':
-                await get_file_from_device("txt", verbose, ack_chunk_size=g_ack_chunk_size)
+                await get_file_from_device("txt", verbose, ack_chunk_size=g_ack_chunk_size, compress=g_use_compression)
             elif choice == '5':
                 await get_file_from_device("wav", verbose, ack_chunk_size=g_ack_chunk_size)
             elif choice == '6':
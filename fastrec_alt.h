@@ -9,6 +9,7 @@
 #include "freertos/task.h"
 #include "freertos/semphr.h"
 #include "ima_adpcm.h"
+#include "lzss.h"
 #include <cstddef>
 
 // GPIO settings
@@ -182,7 +183,13 @@ uint32_t g_totalBytesRecorded = 0;
 volatile bool g_start_file_transfer = false;
 std::string g_file_to_transfer_name;
 int g_chunk_burst_size = 8; 
+bool g_transfer_compressed = false; // LZSS-compress the current GET:file transfer
+LzssEncoder g_lzss_encoder;
 std::string g_lastBleCommand;
+uint16_t g_ble_mtu = 23; // Negotiated ATT MTU, used to size control response packets
+volatile bool g_response_pending = false; // Control response queued by a BLE callback
+std::string g_pending_response;
+volatile bool g_restart_after_response = false;
 
 // Function Prototypes ---
 
@@ -562,5 +562,6 @@ void loop() {
   handleUsbStateChange();
   updateBatteryVoltageTracking();
 
+  sendPendingResponse();
   transferFileChunked();
 }
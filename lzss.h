@@ -0,0 +1,160 @@
+#ifndef LZSS_H
+#define LZSS_H
+
+#include <cstdint>
+#include <cstring>
+#include <cstddef>
+
+// Streaming LZSS encoder used for compressed BLE file transfers.
+//
+// Stream format (decoded by bletool.py):
+//   A flag byte is followed by up to 8 items, LSB first.
+//   Flag bit 1: one literal byte.
+//   Flag bit 0: two-byte back reference (big-endian),
+//               upper 11 bits = distance - 1, lower 5 bits = length - 3.
+//   The stream simply ends after the last item; a trailing group may be short.
+const size_t LZSS_WINDOW_SIZE = 2048;  // Max back reference distance (11 bits)
+const size_t LZSS_MIN_MATCH = 3;
+const size_t LZSS_MAX_MATCH = 34;      // LZSS_MIN_MATCH + 31 (5 bits)
+const size_t LZSS_INPUT_SIZE = 1024;   // Lookahead room on top of the window
+const size_t LZSS_HASH_SIZE = 1024;    // Must be a power of two
+const size_t LZSS_GROUP_ITEMS = 8;
+const size_t LZSS_GROUP_MAX_BYTES = 1 + LZSS_GROUP_ITEMS * 2;
+
+// Encoder state. Everything is fixed-size so it can live in static RAM.
+struct LzssEncoder {
+    uint8_t buf[LZSS_WINDOW_SIZE + LZSS_INPUT_SIZE];
+    uint32_t head[LZSS_HASH_SIZE]; // Last absolute position + 1 for each hash (0 = empty)
+    uint32_t base;                 // Absolute stream position of buf[0]
+    size_t pos;                    // Next byte to encode (index into buf)
+    size_t end;                    // Number of valid bytes in buf
+    bool finishing;                // No more input will be sunk
+    uint8_t group[LZSS_GROUP_MAX_BYTES];
+    size_t groupLen;
+    size_t groupPos;
+};
+
+void lzss_init(LzssEncoder& enc) {
+    memset(enc.head, 0, sizeof(enc.head));
+    enc.base = 0;
+    enc.pos = 0;
+    enc.end = 0;
+    enc.finishing = false;
+    enc.groupLen = 0;
+    enc.groupPos = 0;
+}
+
+static inline uint32_t lzss_hash(const uint8_t* p) {
+    return ((p[0] << 6) ^ (p[1] << 3) ^ p[2]) & (LZSS_HASH_SIZE - 1);
+}
+
+// Record position idx in the hash table and return the previous candidate (absolute pos + 1).
+static inline uint32_t lzss_insert(LzssEncoder& enc, size_t idx) {
+    uint32_t h = lzss_hash(enc.buf + idx);
+    uint32_t candidate = enc.head[h];
+    enc.head[h] = enc.base + idx + 1;
+    return candidate;
+}
+
+// Copies as much input as fits into the encoder. Returns the number of bytes accepted.
+size_t lzss_sink(LzssEncoder& enc, const uint8_t* in, size_t len) {
+    if (enc.finishing) {
+        return 0;
+    }
+
+    if (enc.end == sizeof(enc.buf) && enc.pos > LZSS_WINDOW_SIZE) {
+        // Slide so that exactly one window of history stays in front of pos
+        size_t shift = enc.pos - LZSS_WINDOW_SIZE;
+        memmove(enc.buf, enc.buf + shift, enc.end - shift);
+        enc.base += shift;
+        enc.pos -= shift;
+        enc.end -= shift;
+    }
+
+    size_t space = sizeof(enc.buf) - enc.end;
+    if (len > space) {
+        len = space;
+    }
+    memcpy(enc.buf + enc.end, in, len);
+    enc.end += len;
+    return len;
+}
+
+void lzss_finish(LzssEncoder& enc) {
+    enc.finishing = true;
+}
+
+// Encodes one flag byte plus up to 8 items into enc.group.
+static void lzss_encode_group(LzssEncoder& enc) {
+    uint8_t flags = 0;
+    size_t len = 1;
+
+    for (size_t item = 0; item < LZSS_GROUP_ITEMS && enc.pos < enc.end; item++) {
+        size_t avail = enc.end - enc.pos;
+        size_t matchLen = 0;
+        size_t matchDist = 0;
+
+        if (avail >= LZSS_MIN_MATCH) {
+            uint32_t candidate = lzss_insert(enc, enc.pos);
+            uint32_t current = enc.base + enc.pos;
+            if (candidate != 0 && candidate - 1 >= enc.base && current - (candidate - 1) <= LZSS_WINDOW_SIZE) {
+                const uint8_t* a = enc.buf + (candidate - 1 - enc.base);
+                const uint8_t* b = enc.buf + enc.pos;
+                size_t maxLen = avail < LZSS_MAX_MATCH ? avail : LZSS_MAX_MATCH;
+                while (matchLen < maxLen && a[matchLen] == b[matchLen]) {
+                    matchLen++;
+                }
+                matchDist = current - (candidate - 1);
+            }
+        }
+
+        if (matchLen >= LZSS_MIN_MATCH) {
+            uint16_t code = (uint16_t)(((matchDist - 1) << 5) | (matchLen - LZSS_MIN_MATCH));
+            enc.group[len++] = (uint8_t)(code >> 8);
+            enc.group[len++] = (uint8_t)(code & 0xFF);
+            // Keep the hash table fresh for the positions covered by the match
+            for (size_t i = 1; i < matchLen; i++) {
+                if (enc.end - (enc.pos + i) >= LZSS_MIN_MATCH) {
+                    lzss_insert(enc, enc.pos + i);
+                }
+            }
+            enc.pos += matchLen;
+        } else {
+            flags |= (uint8_t)(1 << item);
+            enc.group[len++] = enc.buf[enc.pos];
+            enc.pos++;
+        }
+    }
+
+    enc.group[0] = flags;
+    enc.groupLen = len;
+    enc.groupPos = 0;
+}
+
+// Writes up to outLen compressed bytes. Returns 0 when more input is needed
+// (or, after lzss_finish(), when the stream is complete).
+size_t lzss_poll(LzssEncoder& enc, uint8_t* out, size_t outLen) {
+    size_t written = 0;
+    while (written < outLen) {
+        if (enc.groupPos < enc.groupLen) {
+            size_t n = enc.groupLen - enc.groupPos;
+            if (n > outLen - written) {
+                n = outLen - written;
+            }
+            memcpy(out + written, enc.group + enc.groupPos, n);
+            enc.groupPos += n;
+            written += n;
+            continue;
+        }
+
+        // A group may consume up to 8 full matches; only start one with enough lookahead
+        size_t avail = enc.end - enc.pos;
+        if (avail == 0 || (!enc.finishing && avail < LZSS_GROUP_ITEMS * LZSS_MAX_MATCH)) {
+            break;
+        }
+        lzss_encode_group(enc);
+    }
+    return written;
+}
+
+#endif // LZSS_H